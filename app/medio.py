@@ -6,28 +6,47 @@
 import re, os, time, sys, traceback, subprocess
 import pyinotify
 import configparser 
-import queue
-import filecmp
-from threading import Thread, Timer
+import hashlib
+import heapq
+import mmap
+from collections import deque
+from threading import Thread, Event, Lock, Condition
 
 PKGDIR="/app"
 SRCDIR="/source"
 DSTDIR="/dest"
 
-ACCEPTED_EXTENSIONS = ['.jpg', '.jpeg', '.mpg', '.mp4', '.png',
-                       '.mov', '.thm', '.avi', '.raw', '.arw', 
-                       '.heic', '.heif', '.nef', '.3gp']
+ACCEPTED_EXTENSIONS = frozenset(['.jpg', '.jpeg', '.mpg', '.mp4', '.png',
+                                 '.mov', '.thm', '.avi', '.raw', '.arw', 
+                                 '.heic', '.heif', '.nef', '.3gp'])
 
 def log(msg):
     print('[%s] %s\n' % (time.ctime(), str(msg)))
 
+def hash_file(path):
+    """Return a digest of a file's contents.  Large files are mmap'ed so they are
+       hashed straight from the page cache rather than copied through read buffers."""
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= 10 * 1024 * 1024:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        else:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
 class Config(object):
     DEFAULT_DSTFMT =  r'%Y/%m/%Y%m%d_%H%M%S%%-uc.%%e'
 
     def __init__(self):
-        log('ENV FORMAT: ' + os.environ.get('FORMAT', self.DEFAULT_DSTFMT))
-        log('ENV DELETE_DUPLICATE: ' + os.environ.get('DELETE_DUPLICATE', True))
-        log('ENV LOCALE: ' + os.environ.get('LOCALE', 'zh_CN.utf8'))
+        # The environment can't change under us, so read it once up front
+        self.dstfmt = os.environ.get('FORMAT', self.DEFAULT_DSTFMT)
+        self.delete_dups = os.environ.get('DELETE_DUPLICATE', 'True').lower() not in ('false', 'no', 'off', '0', '')
+        self.locale = os.environ.get('LOCALE', 'zh_CN.utf8')
+        log('ENV FORMAT: ' + self.dstfmt)
+        log('ENV DELETE_DUPLICATE: ' + str(self.delete_dups))
+        log('ENV LOCALE: ' + self.locale)
 
     @property
     def UI_SRCDIR(self):
@@ -39,130 +58,330 @@ class Config(object):
 
     @property
     def UI_DSTFMT(self):
-        return os.environ.get('FORMAT', self.DEFAULT_DSTFMT)
+        return self.dstfmt
 
     @property
     def UI_DELETE_DUPS(self):
-        return os.environ.get('DELETE_DUPLICATE', True)
+        return self.delete_dups
 
     @property
     def UI_LOCALE(self):
-        return os.environ.get('LOCALE', 'zh_CN.utf8')
-
-class Spawn(object):
-    """A wrapper around subprocess just to save boilerplate"""
-    def __init__(self, args, shell=False, env=None):
-        handle = subprocess.Popen(args, stdin=open(os.devnull, 'r'), stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, close_fds=True, text=True, shell=shell, 
-                                  env=env)
-        self.stdout, self.stderr = handle.communicate()
-        self.retval = handle.wait()
-
-class LoggingTimer(Timer):
-    """A threading.Timer that will catch exceptions in run() and log them to our
-       global log file.  Without this, threads would throw and exit, but leave
-       no trace."""
-    def run(self):
-        try:
-            Timer.run(self)
-        except:
-            err = traceback.format_exc(2)
-            log(err)
+        return self.locale
+
+class WorkQueue(object):
+    """A minimal producer/consumer queue: a deque guarded by a single Condition.
+       Cheaper per operation than queue.Queue and lets a consumer take a whole batch
+       in one lock acquisition."""
+    def __init__(self):
+        self.items = deque()
+        self.cv = Condition()
+
+    def put(self, item):
+        with self.cv:
+            self.items.append(item)
+            self.cv.notify()
+
+    def get_batch(self, limit):
+        """Block until there is work, then return up to limit items"""
+        with self.cv:
+            while not self.items:
+                self.cv.wait()
+            return [self.items.popleft() for _ in range(min(limit, len(self.items)))]
+
+    def get(self):
+        return self.get_batch(1)[0]
+
+class ExifToolError(Exception):
+    """The exiftool process died while running a command"""
+
+class ExifTool(object):
+    """A long-lived exiftool process fed through its -stay_open argfile on stdin, so
+       we only pay the perl startup and module load cost once instead of per file.
+       The pipes are binary and paths go through os.fsencode/os.fsdecode, so file
+       names round-trip byte for byte whatever the locale."""
+    SENTINEL = b'{ready}'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.handle = None
+        self.spawn()
+
+    def spawn(self):
+        """Start (or restart) the exiftool process"""
+        if self.handle is not None:
+            self.handle.kill()
+            self.handle.wait()
+            for stream in (self.handle.stdin, self.handle.stdout, self.handle.stderr):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self.handle = subprocess.Popen([os.path.join(PKGDIR, 'exiftool'), '-stay_open', 'True', '-@', '-'],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, close_fds=True)
+
+    def _read(self, stream):
+        """Read a stream up to the next {ready} line, returning everything before it"""
+        lines = []
+        for line in iter(stream.readline, b''):
+            if line.rstrip(b'\n') == self.SENTINEL:
+                return os.fsdecode(b''.join(lines))
+            lines.append(line)
+        raise RuntimeError('exiftool exited unexpectedly')
+
+    def execute(self, args):
+        """Run one exiftool command and return its (stdout, stderr).  exiftool prints
+           {ready} to stdout after each -execute; -echo4 marks the end of stderr."""
+        # The argfile is one argument per line, so a newline in an argument would
+        # smuggle extra options (even -if perl code) into exiftool
+        if any('\n' in arg or '\r' in arg for arg in args):
+            raise ValueError('exiftool arguments must not contain newlines')
+        argfile = b''.join(os.fsencode(arg) + b'\n' for arg in args)
+        with self.lock:
+            if self.handle.poll() is not None:
+                log('exiftool exited with status %d, restarting it' % self.handle.returncode)
+                self.spawn()
+            try:
+                self.handle.stdin.write(argfile + b'-echo4\n' + self.SENTINEL + b'\n-execute\n')
+                self.handle.stdin.flush()
+                return self._read(self.handle.stdout), self._read(self.handle.stderr)
+            except (OSError, RuntimeError) as e:
+                # Leave a fresh process behind for the next command either way
+                self.spawn()
+                raise ExifToolError('exiftool died during a command: %s' % e)
+
+    def close(self):
+        with self.lock:
+            if self.handle.poll() is None:
+                self.handle.stdin.write(b'-stay_open\nFalse\n')
+                self.handle.stdin.flush()
+                self.handle.communicate()
 
 class Worker(Thread):
-    """A single thread to do most of the work.  Waits on a Queue for new work"""
-    rename_re = re.compile(r"'(\S+)'\s+-->\s+'(\S+)'")
+    """A single thread to do most of the work.  Waits on a Queue for new work.
+       There must only be one: exiftool picks a free destination name (and %-c copy
+       number) by checking for the file and then rename()ing over it, so two running
+       at once can pick the same name and one silently overwrites the other."""
+    rename_re = re.compile(r"^'(\S+)'\s+-->\s+'(\S+)'", re.MULTILINE)
+    BATCH_SIZE = 64
     cfg = None
     workq = None
+    dedupq = None
 
-    def __init__(self, cfg, workq):
+    def __init__(self, cfg, workq, dedupq):
         Thread.__init__(self)
         self.cfg = cfg
         self.workq = workq
+        self.dedupq = dedupq
+        self.exiftool = ExifTool()
         self.start()
 
-    def process_file(self, path):
-        """This does the bulk of the work.  Calls exiftool to do the rename and synoindex 
-           to tell DSM about it."""
+    def process_files(self, paths):
+        """This does the bulk of the work.  Calls exiftool once to rename a whole batch
+           of files and hands possible duplicates off to the DedupWorker."""
         # Use exiftool to do the rename
-        srcfile = os.path.join(self.cfg.UI_SRCDIR, path)
+        srcfiles = []
+        for path in paths:
+            if '\n' in path or '\r' in path:
+                log('Skipping %r: newlines in file names are not supported' % path)
+                continue
+            srcfiles.append(os.path.join(self.cfg.UI_SRCDIR, path))
+        if not srcfiles:
+            return
         dstfmt = os.path.join(self.cfg.UI_DSTDIR, self.cfg.UI_DSTFMT)
-        dstfile = None
-        cmd = [os.path.join(PKGDIR, 'exiftool'), '-v', '-r', '-d', dstfmt, 
+        # -v is the lowest verbosity that reports renames (-p is ignored when writing).
+        # -fast2 skips JPEG trailers and MakerNotes, which we don't need for dates.
+        cmd = ['-v', '-fast2', '-r', '-d', dstfmt, 
                 "-filename<filemodifydate", "-filename<createdate", 
-                "-filename<datetimeoriginal", srcfile]
-        p = Spawn(cmd)
-        if p.retval != 0:
-            log('exiftool FAILED for ' + path + ': ' +  ' '.join(p.stderr.split('\n')))
-            return
-        for line in p.stdout.split('\n'):
-            m = self.rename_re.match(line)
-            if m and m.group(1) == srcfile:
-                dstfile = m.group(2)
-                common = os.path.commonprefix([srcfile, dstfile])
-                log('Moved %s to %s' % (os.path.relpath(srcfile, common), 
-                                        os.path.relpath(dstfile, common)))
-                if self.cfg.UI_DSTFMT == self.cfg.DEFAULT_DSTFMT and self.cfg.UI_DELETE_DUPS and '-' in dstfile:
-                    extension = os.path.splitext(dstfile)[1]
-                    dupfile = dstfile.split('-')[0] + extension
-                    log('Check if %s is a duplicate file of %s' % (dstfile, dupfile))
-                    if (os.path.exists(dupfile) and filecmp.cmp(dstfile, dupfile, False)):
-                        os.remove(dstfile)
-                        log("Removed %s: a duplicate of %s" % (dstfile, dupfile))
-
-        if dstfile is None:
-            log('exiftool succeeded, but no file rename information found')
+                "-filename<datetimeoriginal"] + srcfiles
+        stdout, stderr = self.exiftool.execute(cmd)
+        errors = [line for line in stderr.split('\n') if line.startswith('Error')]
+        if errors:
+            log('exiftool FAILED: ' + ' '.join(errors))
+        check_dups = self.cfg.UI_DSTFMT == self.cfg.DEFAULT_DSTFMT and self.cfg.UI_DELETE_DUPS
+        renames = {}
+        for m in self.rename_re.finditer(stdout):
+            renames[m.group(1)] = m.group(2)
+        for srcfile in srcfiles:
+            dstfile = renames.get(srcfile)
+            if dstfile is None:
+                if not any(srcfile in error for error in errors):
+                    log('exiftool succeeded, but no file rename information found for ' + srcfile)
+                continue
+            log('Moved %s to %s' % (os.path.relpath(srcfile, self.cfg.UI_SRCDIR), 
+                                    os.path.relpath(dstfile, self.cfg.UI_DSTDIR)))
+            if check_dups and '-' in dstfile:
+                extension = os.path.splitext(dstfile)[1]
+                dupfile = dstfile.split('-')[0] + extension
+                self.dedupq.put((dstfile, dupfile))
+
+    def process_batch(self, paths):
+        """Rename a batch, falling back to one file at a time if exiftool dies so a
+           file that crashes it only costs itself.  exiftool has already been
+           restarted by then, so this isn't counted against the Worker's errors."""
+        try:
+            self.process_files(paths)
+        except ExifToolError as e:
+            log(e)
+            if len(paths) > 1:
+                for path in paths:
+                    self.process_batch([path])
+            else:
+                log('Giving up on %s' % paths[0])
 
     def run(self):
         errorCount = 0
         while errorCount < 5:
             try:
-                path = self.workq.get()
-                self.process_file(path)
-                self.workq.task_done()
+                # Block for one path and take whatever else is already queued with it
+                paths = self.workq.get_batch(self.BATCH_SIZE)
+                self.process_batch(paths)
             except:
                 errorCount += 1
                 err = traceback.format_exc(2)
                 log(err)
         log('Too many errors, Worker thread exiting')
+        self.exiftool.close()
+
+class DedupWorker(Thread):
+    """A thread that removes renamed files which duplicate an existing file.  Kept off
+       the Worker so hashing doesn't hold up the next exiftool batch."""
+    DIGEST_CACHE_SIZE = 4096
+    cfg = None
+    dedupq = None
+
+    def __init__(self, cfg, dedupq):
+        Thread.__init__(self)
+        self.cfg = cfg
+        self.dedupq = dedupq
+        self.digests = {}
+        self.start()
+
+    def digest(self, path, st):
+        """Return the digest of a file, cached by path, size and mtime so a burst of
+           copies compared against the same original only reads the original once"""
+        key = (path, st.st_size, st.st_mtime_ns)
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = self.digests[key] = hash_file(path)
+            # Evict the oldest entry so a long-running container doesn't grow forever
+            if len(self.digests) > self.DIGEST_CACHE_SIZE:
+                del self.digests[next(iter(self.digests))]
+        return digest
+
+    def is_duplicate(self, dstfile, dupfile):
+        """Decide from the stats alone where we can: the same inode is trivially the
+           same file and different sizes can never match.  Only hash when sizes agree."""
+        dststat, dupstat = os.stat(dstfile), os.stat(dupfile)
+        if dststat.st_ino == dupstat.st_ino and dststat.st_dev == dupstat.st_dev:
+            return True
+        if dststat.st_size != dupstat.st_size:
+            return False
+        return self.digest(dstfile, dststat) == self.digest(dupfile, dupstat)
+
+    def process_file(self, dstfile, dupfile):
+        log('Check if %s is a duplicate file of %s' % (dstfile, dupfile))
+        try:
+            duplicate = self.is_duplicate(dstfile, dupfile)
+        except FileNotFoundError:
+            # Either file may have been moved away while this was queued
+            return
+        if duplicate:
+            os.remove(dstfile)
+            log("Removed %s: a duplicate of %s" % (dstfile, dupfile))
+
+    def run(self):
+        errorCount = 0
+        while errorCount < 5:
+            try:
+                dstfile, dupfile = self.dedupq.get()
+                self.process_file(dstfile, dupfile)
+            except:
+                errorCount += 1
+                err = traceback.format_exc(2)
+                log(err)
+        log('Too many errors, DedupWorker thread exiting')
 
 class Watcher(Thread):
     """A thread to watch files that are in transit"""
     cfg = None
     workq = None
     watchq = None
-    timer = None
-    active = {}
+    wake = None
+    lock = None
+    active = None
+    expiries = None
+    QUIET_TIME = 30
 
     def __init__(self, cfg, workq, watchq):
         Thread.__init__(self)
         self.cfg = cfg
         self.workq = workq
         self.watchq = watchq
+        self.wake = Event()
+        self.lock = Lock()
+        # Latest (timestamp, size) per file plus a heap of (expiry, path) so a scan
+        # only looks at files that are due rather than every active one
+        self.active = {}
+        self.expiries = []
+        Thread(target=self.scan_actives, daemon=True).start()
         self.start()
 
+    def scan_actives(self):
+        """Runs for the life of the Watcher, sleeping until the next file is due or
+           until woken by a new event"""
+        timeout = None
+        while True:
+            self.wake.wait(timeout)
+            self.wake.clear()
+            try:
+                timeout = self.check_actives()
+            except:
+                timeout = 5
+                err = traceback.format_exc(2)
+                log(err)
+
     def check_actives(self):
-        # Check all actives
-        now = time.time()
-        delete_keys = []
-        for filepath, tstamp in self.active.items():
-            if now - tstamp > 30:
-                self.workq.put(filepath)
-                delete_keys.append(filepath)
-        for filepath in delete_keys:
-            del self.active[filepath]
-        # Check again soon if there's more
-        if len(self.active) > 0:
-            if self.timer:
-                self.timer.cancel()
-            self.timer = LoggingTimer(5, self.check_actives)
-            self.timer.start()
+        """Hand off due files whose size has held steady and return how long until
+           the next one is due, or None if there are none"""
+        now = time.monotonic()
+        with self.lock:
+            while self.expiries and self.expiries[0][0] <= now:
+                expiry, filepath = heapq.heappop(self.expiries)
+                entry = self.active.get(filepath)
+                # Skip stale heap entries for files that have been seen again since
+                if entry is None or entry[0] + self.QUIET_TIME > now:
+                    continue
+                try:
+                    newsize = os.stat(filepath).st_size
+                except FileNotFoundError:
+                    del self.active[filepath]
+                    continue
+                if newsize == entry[1]:
+                    # A file that stayed empty was never written; leave it be
+                    if newsize > 0:
+                        self.workq.put(filepath)
+                    del self.active[filepath]
+                else:
+                    self.track(filepath, now, newsize)
+            if self.expiries:
+                return self.expiries[0][0] - now
+            return None
+
+    def track(self, path, now, filesize):
+        self.active[path] = (now, filesize)
+        heapq.heappush(self.expiries, (now + self.QUIET_TIME, path))
 
     def process_file(self, path):
-        filesize = os.path.exists(path) and os.stat(path).st_size or 0
-        if filesize > 0:
-            self.active[path] = time.time()
-            self.check_actives()
+        try:
+            filesize = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        # Track empty files too: the event that would report their data may have been
+        # debounced away, and the size check re-arms them once it shows up
+        with self.lock:
+            self.track(path, time.monotonic(), filesize)
+        self.wake.set()
 
     def run(self):
         errorCount = 0
@@ -170,7 +389,6 @@ class Watcher(Thread):
             try:
                 path = self.watchq.get()
                 self.process_file(path)
-                self.watchq.task_done()
             except:
                 errorCount += 1
                 err = traceback.format_exc(2)
@@ -187,27 +405,59 @@ class EventHandler(pyinotify.ProcessEvent):
         self.cfg = cfg
         self.workq = workq
         self.watchq = watchq
-        # Check for files we may have missed and queue them
-        for entry in os.listdir(self.cfg.UI_SRCDIR):
-            if self.is_relevant_file(entry):
-                self.watchq.put(os.path.join(self.cfg.UI_SRCDIR, entry))
+        self.recent = {}
+        self.recent_limit = 1024
+        # Check for files we may have missed and queue them.  Anything with data that
+        # hasn't changed for a minute was finished before we started, so skip the
+        # Watcher's quiet wait.  Use ctime as well as mtime because copies made with
+        # cp -p, rsync -t or over SMB carry the source's old mtime, while ctime can't
+        # be set by the client.
+        now = time.time()
+        with os.scandir(self.cfg.UI_SRCDIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and self.is_relevant_file(entry.name):
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if st.st_size > 0 and now - max(st.st_mtime, st.st_ctime) > 60:
+                        self.workq.put(entry.path)
+                    else:
+                        self.watchq.put(entry.path)
 
     def is_relevant_file(self, path):
-        """Return whether or not we care about this file type"""
-        (root, ext) = os.path.splitext(path)
-        if ext.lower() in ACCEPTED_EXTENSIONS:
-            return True
-        return False
+        """Return whether or not we care about this file type.  This runs for every
+           inotify event, so avoid splitext and use a set lookup."""
+        i = path.rfind('.')
+        return i >= 0 and path[i:].lower() in ACCEPTED_EXTENSIONS
+
+    def watch_file(self, path):
+        """Queue a path for the Watcher unless we already did so in the last couple of
+           seconds.  Network uploads fire a storm of events for the same file and the
+           Watcher only needs to hear about it once in a while."""
+        now = time.monotonic()
+        last = self.recent.get(path)
+        if last is not None and now - last < 2.0:
+            return
+        self.recent[path] = now
+        if len(self.recent) > self.recent_limit:
+            self.recent = {p: t for p, t in self.recent.items() if now - t < 60}
+            # Let the map double before pruning again so a bulk import of thousands
+            # of live paths doesn't rebuild it on every event
+            self.recent_limit = max(1024, 2 * len(self.recent))
+        self.watchq.put(path)
 
     def process_IN_CREATE(self, event):
-        """We see this when we upload via the network (NFS, AFS, SMB)"""
+        """We see this when we upload via the network (NFS, AFS, SMB).  It fires once
+           per file, usually while it is still empty, so it's not debounced and the
+           first close-write after it still gets through."""
         if self.is_relevant_file(event.pathname):
             self.watchq.put(event.pathname)
         
     def process_IN_CLOSE_WRITE(self, event):
         """We see lots of these per file when uploading via the network"""
         if self.is_relevant_file(event.pathname):
-            self.watchq.put(event.pathname)
+            self.watch_file(event.pathname)
 
     def process_IN_MOVED_TO(self, event):
         """We see this when the DS photo app uploads stuff or we use file manager to move
@@ -218,17 +468,20 @@ class EventHandler(pyinotify.ProcessEvent):
 if __name__ == '__main__':
     try:
         cfg = Config()
-        workq = queue.Queue()
-        watchq = queue.Queue()
-        worker = Worker(cfg, workq)
+        # Set before the Worker starts exiftool so it inherits the locale
+        if cfg.UI_LOCALE:
+            log('Forcing LOCALE to %s' % cfg.UI_LOCALE)
+            os.environ['LC_ALL'] = cfg.UI_LOCALE
+        workq = WorkQueue()
+        watchq = WorkQueue()
+        dedupq = WorkQueue()
+        worker = Worker(cfg, workq, dedupq)
+        deduper = DedupWorker(cfg, dedupq)
         watcher = Watcher(cfg, workq, watchq)
         wm = pyinotify.WatchManager()
         notifier = pyinotify.Notifier(wm, EventHandler(cfg, workq, watchq))
         mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
         wdd = wm.add_watch(cfg.UI_SRCDIR, mask)
-        if cfg.UI_LOCALE:
-            log('Forcing LOCALE to %s' % cfg.UI_LOCALE)
-            os.environ['LC_ALL'] = cfg.UI_LOCALE
         log('Source directory: %s' % cfg.UI_SRCDIR)
         log('Destination directory: %s' % cfg.UI_DSTDIR)
         log('Destination filename format: %s' % cfg.UI_DSTFMT)